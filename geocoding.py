@@ -1,9 +1,30 @@
-import time
+import asyncio
 import geopy
+import os
 import requests
+import threading
+import time
 import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from geopy.adapters import AioHTTPAdapter
+from geopy.extra.rate_limiter import AsyncRateLimiter
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
+from urllib3.util.retry import Retry
+
+# orjson is optional, it parses large responses faster than stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# diskcache is optional, without it lookups are not cached
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
 
 # show all columns in pandas
 pd.set_option("display.max_columns", None)
@@ -14,7 +35,30 @@ class ReverseGeocoding:
     This class contains methods for reverse geocoding
     """
 
-    def __init__(self, api_key=""):
+    def __init__(self, api_key="", max_workers=16, cache_dir="~/.cache/geoutils"):
+
+        # shared http session, pooled connections are reused across threads
+        # and failed requests are retried by urllib3
+        self.session = requests.Session()
+        retry = Retry(total=10,
+                      backoff_factor=0.3,
+                      status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=["GET"],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=32,
+                              pool_maxsize=32,
+                              max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.max_workers = max_workers
+
+        # on-disk cache of successful lookups, keyed by rounded coordinates; None disables caching
+        # the cache is only opened on first lookup
+        if cache_dir and diskcache is not None:
+            self.cache_dir = os.path.join(os.path.expanduser(cache_dir), "geocoding")
+        else:
+            self.cache_dir = None
+        self._cache_obj = None
+        self._cache_lock = threading.Lock()
 
         # Google geocoding
         self.api_key = api_key
@@ -24,6 +68,68 @@ class ReverseGeocoding:
         # USGS Elevation Point Query Service (EPQS)
         self.epqs_baseurl = "https://epqs.nationalmap.gov/v1/json?"
 
+    @property
+    def _cache(self):
+        """
+        Used to open the on-disk lookup cache lazily, shared across threads
+        :return: diskcache.Cache, or None if caching is disabled
+        """
+
+        if self._cache_obj is None and self.cache_dir is not None:
+            with self._cache_lock:
+                if self._cache_obj is None:
+                    self._cache_obj = diskcache.Cache(self.cache_dir)
+        return self._cache_obj
+
+    @staticmethod
+    def _cache_key(kind, lat, lon, option):
+        """
+        Used to build cache key of a lookup, coordinates are rounded to 5 decimals (~1 m)
+        :param kind: lookup type, e.g. "gzip" or "epqs"
+        :param lat: latitude
+        :param lon: longitude
+        :param option: lookup option affecting the result, e.g. result_type or units
+        :return: cache key tuple
+        """
+
+        return kind, round(float(lat), 5), round(float(lon), 5), option
+
+    @staticmethod
+    def _missing_mask(s):
+        """
+        Used to find rows still to be mapped, i.e. NaN or "None" values
+        :param s: series to check
+        :return: boolean array, True where value is missing
+        """
+
+        return (s.isna() | (s == "None")).to_numpy(dtype=bool)
+
+    @staticmethod
+    def _parse_json(response):
+        """
+        Used to parse json response body, with orjson if available
+        :param response: requests response
+        :return: parsed json
+        """
+
+        if orjson is not None:
+            return orjson.loads(response.content)
+        return response.json()
+
+    @staticmethod
+    def _unique_coordinates(coords):
+        """
+        Used to deduplicate coordinates so that each location is only queried once
+        :param coords: 2-D array with one (latitude, longitude) row per location
+        :return: unique coordinates and inverse indices to broadcast results back to coords
+        """
+
+        if len(coords) == 0:
+            return coords, np.empty(0, dtype=np.intp)
+        uniq, inverse = np.unique(coords, axis=0, return_inverse=True)
+
+        return uniq, inverse.reshape(-1)
+
     def geo2zip(self, lat, lon, result_type="postal_code"):
         """
         Used for reverse geocoding with Google Geocoding API to get zip codes
@@ -33,17 +139,27 @@ class ReverseGeocoding:
         :return: 5 digit zop code
         """
 
+        key = self._cache_key("gzip", lat, lon, result_type)
+        cached = self._cache.get(key) if self._cache is not None else None
+        if cached is not None:
+            return cached
+
         base_url = self.ggeo_baseurl
         url = f"{base_url}" + \
               f"{str(lat)},{str(lon)}" + \
               f"&result_type={result_type}" + \
               f"&key={self.api_key}"
 
-        response = requests.get(url)
-        result = response.json()["results"]
+        response = self.session.get(url, timeout=10)
+        if response.status_code != 200:
+            print(f"Failed attempt with status code {response.status_code}")
+            return np.nan
+        result = self._parse_json(response)["results"]
 
         if len(result) > 0:
             gzip = result[0]["address_components"][0]["long_name"]
+            if self._cache is not None:
+                self._cache[key] = gzip
         else:
             gzip = np.nan
         return gzip
@@ -57,6 +173,11 @@ class ReverseGeocoding:
         :return: elevation
         """
 
+        key = self._cache_key("epqs", lat, lon, units)
+        cached = self._cache.get(key) if self._cache is not None else None
+        if cached is not None:
+            return cached
+
         base_url = self.epqs_baseurl
         url = f"{base_url}" + \
               f"x={lon}&" + \
@@ -65,32 +186,36 @@ class ReverseGeocoding:
               "wkid=4326&" + \
               "includeDate=False"
 
-        # epqs always return status 200 but might not be able to return json
-        # hence this try-except loop
-        try:
-            js = requests.get(url).json()
-        except Exception as e:
-            print(f"{type(e)}: {e}")
-            try_count = 0
-            js = {}
-            # as API sometimes failed to parse json without clear reason
-            # we will try to request 10 times before giving up
-            while len(js) == 0 or not js:
-                try:
-                    js = requests.get(url).json()
-                except Exception as e:
-                    print(f"{type(e)}: {e}")
-                    try_count += 1
-                    js = {}
-                    time.sleep(10)
-                if try_count == 10:
-                    break
+        # connection errors and 5xx responses are retried with exponential backoff by the session adapter
+        # epqs always return status 200 but might not be able to return json,
+        # the adapter does not cover that case, hence this short retry loop
+        js = {}
+        for attempt in range(3):
+            try:
+                response = self.session.get(url, timeout=10)
+            except requests.exceptions.RequestException as e:
+                print(f"{type(e)}: {e}")
+                return np.nan
+
+            # non-200 responses were already retried by the adapter
+            if response.status_code != 200:
+                print(f"Failed attempt with status code {response.status_code}")
+                return np.nan
+
+            try:
+                js = self._parse_json(response)
+                break
+            except ValueError as e:
+                print(f"{type(e)}: {e}")
+                if attempt < 2:
+                    time.sleep(0.3 * 2 ** attempt)
 
-        # check again in case all tries failed
         try:
             # check for real elevation values
             if (js["value"] > -450) and (js["value"] < 9000):
                 elevation = js["value"]
+                if self._cache is not None:
+                    self._cache[key] = elevation
             else:
                 elevation = np.nan
         except Exception as e:
@@ -113,31 +238,27 @@ class ReverseGeocoding:
 
         # google elevation api allows up to 512 locations per query
         # here  we divide lat, lon pairs into chunks of 500
-        df["glocations"] = df["latitude"].astype(str) + "%2C" + df["longitude"].astype(str)
+        # fixed-point formatting, google rejects scientific notation such as 5e-05
+        lat_strings = np.char.mod("%.6f", df["latitude"].to_numpy(dtype=np.float64))
+        lon_strings = np.char.mod("%.6f", df["longitude"].to_numpy(dtype=np.float64))
+        df["glocations"] = np.char.add(np.char.add(lat_strings, "%2C"), lon_strings)
         locations = df["glocations"].tolist()
-        n_chunks = len(locations) // 500 + 1
-        chunks = []
-        for i in range(n_chunks):
-            chunks.append(locations[i * 500:(i + 1) * 500])
+        chunks = [locations[i:i + 500] for i in range(0, len(locations), 500)]
+        loc_strings = ["%7C".join(chunk) for chunk in chunks]
 
-        # make api requests with chunks of location
+        # make api requests with chunks of location, all chunks are sent concurrently
         base_url = self.gele_baseurl
-        outputs = []
-        for chunk in tqdm(chunks):
-            loc_string = "%7C".join(chunk)
-            url = f"{base_url}" + \
-                  f"{loc_string}" + \
-                  f"&key={self.api_key}"
-            response = requests.get(url)
-
+        urls = [f"{base_url}" + f"{loc_string}" + f"&key={self.api_key}" for loc_string in loc_strings]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            responses = list(tqdm(executor.map(lambda u: self.session.get(u, timeout=10), urls),
+                                  total=len(urls)))
+
+        # preallocate outputs and fill slice by slice, chunks keep input order
+        outputs = np.full(len(locations), np.nan, dtype=np.float64)
+        for start, url, response in zip(range(0, len(locations), 500), urls, responses):
             if response.status_code == 200:
-                results = response.json()["results"]
-
-                if len(results) > 0:
-                    ele_list = [i["elevation"] for i in results]
-                else:
-                    ele_list = list(np.empty(len(results)).fill(np.nan))
-                outputs = outputs + ele_list
+                results = self._parse_json(response)["results"]
+                outputs[start:start + len(results)] = [i["elevation"] for i in results]
 
             else:
                 print(f"Failed attempt with status code {response.status_code}")
@@ -149,6 +270,37 @@ class ReverseGeocoding:
 
         return df
 
+    @staticmethod
+    async def _get_zips_async(coords):
+        """
+        Used for reverse geocoding coordinates concurrently with GeoPy Nominatim
+        :param coords: iterable of (latitude, longitude) pairs
+        :return: list of geopy locations, None for failed lookups
+        """
+
+        async with geopy.Nominatim(user_agent="geoutils", adapter_factory=AioHTTPAdapter) as geolocator:
+            # Nominatim usage policy allows at most 1 request per second
+            reverse = AsyncRateLimiter(geolocator.reverse, min_delay_seconds=1.0, max_retries=3)
+            return await tqdm_asyncio.gather(*[reverse(f"{lat}, {lon}") for lat, lon in coords],
+                                             total=len(coords))
+
+    @staticmethod
+    def _run_async(coro):
+        """
+        Used to run a coroutine to completion, also from within a running event loop (e.g. Jupyter)
+        :param coro: coroutine to run
+        :return: result of coroutine
+        """
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coro)
+
+        # an event loop is already running in this thread, run in a separate one
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, coro).result()
+
     def get_zip(self, df, zip_column=None, use_geopy=True):
         """
         Used to get zip code for a dataframe containing "latitude" and "longitude" columns
@@ -166,8 +318,10 @@ class ReverseGeocoding:
         # GeoPy
         if use_geopy:
             print(f"Zip mapping {total_count} stations with GeoPy")
-            geolocator = geopy.Nominatim(user_agent="1234")
-            df["geopy_location"] = [geolocator.reverse((x, y)) for x, y in tqdm(zip(df["latitude"], df["longitude"]))]
+            coords = df[["latitude", "longitude"]].to_numpy(dtype=np.float64)
+            uniq, inverse = self._unique_coordinates(coords)
+            locations = self._run_async(self._get_zips_async(uniq))
+            df["geopy_location"] = [locations[j] for j in inverse]
             # data_processing
             zip_list = []
             for i in df["geopy_location"]:
@@ -194,13 +348,15 @@ class ReverseGeocoding:
 
         # data processing
         df["gzip"] = df["_zip"]
-        ids = df.index[df["gzip"].isna()].tolist()
-        for i in tqdm(ids):
-            lat = df.iloc[i, df.columns.get_loc("latitude")]
-            lon = df.iloc[i, df.columns.get_loc("longitude")]
-            df.iloc[i, df.columns.get_loc("gzip")] = self.geo2zip(lat, lon)
-        df.loc[~df["gzip"].isna(), "zip3"] = df["gzip"].str[:3]
-        df.loc[df["zip3"].isna(), "zip3"] = np.nan
+        ids = np.flatnonzero(df["gzip"].isna().to_numpy())
+        coords = df.iloc[ids][["latitude", "longitude"]].to_numpy(dtype=np.float64)
+        uniq, inverse = self._unique_coordinates(coords)
+        gzips = np.empty(len(uniq), dtype=object)
+        for n, (lat, lon) in enumerate(tqdm(uniq)):
+            gzips[n] = self.geo2zip(lat, lon)
+        df.iloc[ids, df.columns.get_loc("gzip")] = gzips[inverse]
+        df["gzip"] = df["gzip"].astype("string")
+        df["zip3"] = df["gzip"].str[:3]
         df.drop(columns="_zip", inplace=True)
 
         # report
@@ -227,18 +383,17 @@ class ReverseGeocoding:
 
         if methods == "epqs":
             # missing values ids
-            ids = df.index[
-                (df["elevation"] == "None") |
-                (df["elevation"].isna())
-                ].tolist()
+            ids = np.flatnonzero(self._missing_mask(df["elevation"]))
             total_count = len(ids)
 
             # mapping elevation
-            print(f"Elevation mapping {total_count} locations.")
-            for i in tqdm(ids):
-                lat = df.iloc[i, df.columns.get_loc("latitude")]
-                lon = df.iloc[i, df.columns.get_loc("longitude")]
-                df.iloc[i, df.columns.get_loc("elevation")] = self.epqs_elevation(lat, lon)
+            coords = df.iloc[ids][["latitude", "longitude"]].to_numpy(dtype=np.float64)
+            uniq, inverse = self._unique_coordinates(coords)
+            print(f"Elevation mapping {total_count} locations ({len(uniq)} unique).")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                elevations = list(tqdm(executor.map(lambda ll: self.epqs_elevation(*ll), uniq),
+                                       total=len(uniq)))
+            df.iloc[ids, df.columns.get_loc("elevation")] = np.asarray(elevations, dtype=np.float64)[inverse]
 
             # report
             elevation_failed_count = len(df.loc[df["elevation"].isna()])
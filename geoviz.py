@@ -1,13 +1,73 @@
+import json
+import os
 import pandas as pd
 import plotly
 import plotly.express as px
 import requests
+import tempfile
+import time
 
 
 class Choropleth:
 
-    def __init__(self):
+    def __init__(self, cache_dir="~/.cache/geoutils", cache_max_age=30 * 24 * 3600):
         self.county_fips_url = "https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json"
+        # None keeps county geojson in memory only
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self.cache_max_age = cache_max_age
+        self._counties = None
+
+    @property
+    def counties(self):
+        """
+        plotly county geojson, downloaded once then loaded from disk cache until older than cache_max_age seconds
+        :return: county geojson dict
+        """
+
+        if self._counties is not None:
+            return self._counties
+
+        # load from disk cache, a stale copy is kept as fallback in case download fails
+        stale = None
+        cache_path = os.path.join(self.cache_dir, "counties.json") if self.cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    cached = json.load(f)
+                if time.time() - os.path.getmtime(cache_path) < self.cache_max_age:
+                    self._counties = cached
+                    return self._counties
+                stale = cached
+            except (OSError, ValueError) as e:
+                print(f"{type(e)}: {e}")
+
+        # cache missing, stale or unreadable
+        try:
+            response = requests.get(self.county_fips_url, timeout=10)
+            response.raise_for_status()
+            self._counties = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if stale is None:
+                raise
+            print(f"{type(e)}: {e}")
+            print("Using stale cached county geojson.")
+            self._counties = stale
+            return self._counties
+
+        if cache_path:
+            tmp_path = None
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with tempfile.NamedTemporaryFile("w", dir=self.cache_dir, suffix=".tmp", delete=False) as f:
+                    tmp_path = f.name
+                    json.dump(self._counties, f)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                print(f"{type(e)}: {e}")
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        return self._counties
 
     def county_choropleth(self,
                           df,
@@ -29,13 +89,9 @@ class Choropleth:
         :return: US choropleth map of county data
         """
 
-        # get plotly county info
-        response = requests.get(self.county_fips_url)
-        counties = response.json()
-
         # assign value for animation_frame if any
         if slider_col:
-            animation_frame = list(df[slider_col])
+            animation_frame = df[slider_col].to_numpy()
         else:
             animation_frame = None
 
@@ -47,9 +103,9 @@ class Choropleth:
 
         # plot us county choropleth
         fig = px.choropleth(df,
-                            geojson=counties,
-                            locations=list(df["county"]),
-                            color=list(df[color_by]),
+                            geojson=self.counties,
+                            locations=df["county"].to_numpy(),
+                            color=df[color_by].to_numpy(),
                             color_continuous_scale=color_scale,
                             range_color=(0, color_max),
                             scope="usa",
@@ -94,7 +150,7 @@ class Choropleth:
             marker_dict = {"size": dot_size,
                            "autocolorscale": False,
                            "colorscale": color_scale,
-                           "color": df[color_by],
+                           "color": df[color_by].to_numpy(),
                            "colorbar": {"title": f"{color_by} {color_unit}"}}
         else:
             marker_dict = {"size": dot_size}
@@ -102,7 +158,7 @@ class Choropleth:
         # main plot data
         if locationmode == "state":
             data = [{"type": "scattergeo",
-                     "locations": df["state"],
+                     "locations": df["state"].to_numpy(),
                      "locationmode": "USA-states",
                      "marker": marker_dict}]
 
@@ -118,8 +174,8 @@ class Choropleth:
 
         elif not locationmode:
             data = [{"type": "scattergeo",
-                     "lat": df["latitude"],
-                     "lon": df["longitude"],
+                     "lat": df["latitude"].to_numpy(),
+                     "lon": df["longitude"].to_numpy(),
                      "marker": marker_dict}]
 
         # plot layout
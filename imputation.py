@@ -1,12 +1,21 @@
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from scipy import spatial
+from sklearn.neighbors import BallTree
 
 # show all columns in pandas
 pd.set_option("display.max_columns", None)
 
 
+def _missing_mask(s):
+    """
+    used to flag missing values, i.e. NaN or "None"
+    :param s: series to check
+    :return: boolean array, True where value is missing
+    """
+
+    return (s.isna() | (s == "None")).to_numpy(dtype=bool)
+
+
 class GeoImputation:
 
     def __init__(self):
@@ -16,79 +25,91 @@ class GeoImputation:
     def closest_location(ref_coordinates, target_coordinate):
         """
         used to find the closest location to target_coordinate
-        :param ref_coordinates: list of tuples of reference coordinates
-        :param target_coordinate: tuple of a pair of coordinate
-        :return: location, a tuple of the closest location
+        :param ref_coordinates: 2-D array of reference coordinates, one (latitude, longitude) row per location
+        :param target_coordinate: array of a pair of coordinate
+        :return: location, an array of the closest location
         """
 
-        # create model with reference data
-        model = spatial.KDTree(ref_coordinates)
+        # create model with reference data, haversine metric works on radians
+        model = BallTree(np.deg2rad(ref_coordinates), metric="haversine")
 
         # find the closest location
-        i = int(model.query(target_coordinate)[1])
+        i = int(model.query(np.deg2rad(np.atleast_2d(target_coordinate)), k=1)[1][0, 0])
         location = ref_coordinates[i]
 
         return location
 
+    @staticmethod
+    def _aggregate(values):
+        """
+        used to combine multiple known values found at the same location
+        :param values: series of known values at one location
+        :return: mean of unique values for numeric data, most common value for strings
+        """
+
+        new_val = values.unique()
+        if new_val.size == 1:
+            new_val = new_val.item()
+        elif type(new_val[0]) is not str:
+            new_val = float(new_val.mean())
+        else:
+            new_val = values.mode().iloc[0]
+
+        return new_val
+
     def impute_col(self, df, col2impute, keep_coordinate=False):
         """
         used to impute a column with missing data based on coordinates
         :param df: dataframe with "latitude", "longitude" & column to impute
         :param col2impute: column contain missing data, must have non-missing data
-        :param keep_coordinate: keep or drop column coordinate, created for imputation
+        :param keep_coordinate: keep or drop columns "imputed_lat" & "imputed_lon", created for imputation
         :return: dataframe with imputed values
         """
 
         # reset index just in case
         df = df.reset_index(drop=True)
 
-        # add coordinate column
-        df["current_loc"] = list(zip(df["latitude"],
-                                     df["longitude"]))
-        df["coordinate"] = df["current_loc"].copy()
-
-        # reference coordinates
-        ref_df = df.loc[
-            (df[col2impute] != "None") &
-            (~df[col2impute].isna())
-            ].reset_index()
-        ref_coordinates = ref_df["coordinate"].to_list()
+        # coordinates and values as separate contiguous arrays
+        lats = df["latitude"].to_numpy(np.float64)
+        lons = df["longitude"].to_numpy(np.float64)
+        vals = df[col2impute].to_numpy()
+        imputed_lats = lats.copy()
+        imputed_lons = lons.copy()
+
+        # reference coordinates and values
+        missing = _missing_mask(df[col2impute])
+        ref_mask = ~missing
+        ref_coordinates = np.column_stack((lats[ref_mask], lons[ref_mask]))
+        ref_values = vals[ref_mask]
+
+        # combine to one value per known location, only duplicated locations need combining
+        dup = pd.DataFrame(ref_coordinates).duplicated(keep=False).to_numpy()
+        if dup.any():
+            combined = pd.Series(ref_values[dup]).groupby(
+                [ref_coordinates[dup, 0], ref_coordinates[dup, 1]]).agg(self._aggregate)
+            ref_coordinates = np.vstack((ref_coordinates[~dup],
+                                         np.array(combined.index.to_list(), dtype=np.float64)))
+            ref_values = np.concatenate((ref_values[~dup], combined.to_numpy()))
 
         # impute missing values
-        ids = df.loc[
-            (df[col2impute] == "None") |
-            (df[col2impute].isna())
-            ].index.tolist()
-
-        print(f"Imputing {len(ids)} data points based on {len(ref_coordinates)} known data points.")
-        for i in tqdm(ids):
-            try:
-                coordinate = df.iloc[i, df.columns.get_loc("coordinate")]
-            except Exception as e:
-                print(f"{type(e)}: {e}")
-                print(i, len(df))
-                return
-            new_loc = self.closest_location(ref_coordinates, coordinate)
-            new_val = ref_df.loc[
-                (ref_df["coordinate"] == new_loc) &
-                ((~ref_df[col2impute].isna()) &
-                 (ref_df[col2impute] != "None")), col2impute
-            ].unique()
-
-            # catch multiple new_val
-            if len(new_val) > 1 and type(new_val[0]) is not str:
-                new_val = np.mean(new_val)
-            elif len(new_val) > 1 and type(new_val[0]) is str:
-                new_val = max(new_val, key=new_val.count)
+        ids = np.flatnonzero(missing)
+
+        print(f"Imputing {len(ids)} data points based on {ref_mask.sum()} known data points.")
+        if len(ids) > 0:
+            # build tree once and query all missing locations in one batch
+            # haversine metric gives great-circle nearest neighbors, it works on radians
+            tree = BallTree(np.deg2rad(ref_coordinates), metric="haversine")
+            _, nn_idx = tree.query(np.deg2rad(np.column_stack((lats[ids], lons[ids]))), k=1)
+            nn_idx = nn_idx[:, 0]
 
             # assign best value
-            df.iloc[i, df.columns.get_loc(col2impute)] = new_val
-            df.iat[i, df.columns.get_loc("coordinate")] = new_loc
+            df.loc[ids, col2impute] = ref_values[nn_idx]
+            imputed_lats[ids] = ref_coordinates[nn_idx, 0]
+            imputed_lons[ids] = ref_coordinates[nn_idx, 1]
 
         if keep_coordinate:
-            df.rename({"coordinate": "imputed_loc"}, axis=1, inplace=True)
-        else:
-            df.drop(["coordinate", "current_loc"], axis=1, inplace=True)
+            df["imputed_lat"] = imputed_lats
+            df["imputed_lon"] = imputed_lons
 
         # report
         total_count = len(ids)